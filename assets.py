@@ -0,0 +1,103 @@
+# сборка статики: копии css/js/шрифтов с хэшем содержимого в имени и заранее сжатые
+# .gz/.br рядом с ними; такие файлы не меняются, поэтому их можно кэшировать навсегда
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ASSET_DIRS = ("css", "js", "webfonts")
+MANIFEST_NAME = "manifest.json"
+# уже сжатые форматы (woff, woff2) повторно не сжимаются
+COMPRESSIBLE = (".css", ".js", ".svg", ".ttf", ".eot")
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def _fingerprint(name, content):
+    base, extension = posixpath.splitext(name)
+    return f"{base}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as asset_file:
+        asset_file.write(content)
+
+
+class AssetBuilder:
+    def __init__(self, static_dir, dist_dir):
+        self.static_dir = static_dir
+        self.dist_dir = dist_dir
+        self.manifest = {}
+
+    def _sources(self):
+        for directory in ASSET_DIRS:
+            for root, _, files in os.walk(os.path.join(self.static_dir, directory)):
+                for filename in sorted(files):
+                    path = os.path.join(root, filename)
+                    yield os.path.relpath(path, self.static_dir).replace(os.sep, "/")
+
+    # ссылки url(...) в css заменяются на имена с хэшем; поэтому css собирается после того,
+    # на что он ссылается (шрифты, импортированные css)
+    def _rewrite_css(self, name, content):
+        def replace(match):
+            quote, url = match.groups()
+            if url.startswith(("data:", "http:", "https:", "//", "/")):
+                return match.group(0)
+            path, suffix = re.match(r"([^?#]*)(.*)", url).groups()
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(name), path))
+            hashed = self.build_one(target)
+            if hashed is None:
+                return match.group(0)
+            relative = posixpath.relpath(hashed, posixpath.dirname(name))
+            return f"url({quote}{relative}{suffix}{quote})"
+        return CSS_URL.sub(replace, content.decode("utf-8")).encode("utf-8")
+
+    def build_one(self, name):
+        if name in self.manifest:
+            return self.manifest[name]
+        source = os.path.join(self.static_dir, name)
+        if not os.path.isfile(source):
+            return None
+        with open(source, "rb") as source_file:
+            content = source_file.read()
+        if name.endswith(".css"):
+            content = self._rewrite_css(name, content)
+        hashed = _fingerprint(name, content)
+        target = os.path.join(self.dist_dir, hashed)
+        _write(target, content)
+        if name.endswith(COMPRESSIBLE):
+            _write(target + ".gz", gzip.compress(content, compresslevel=9, mtime=0))
+            if brotli is not None:
+                _write(target + ".br", brotli.compress(content, quality=11))
+        self.manifest[name] = hashed
+        return hashed
+
+    def build(self):
+        for name in self._sources():
+            self.build_one(name)
+        _write(os.path.join(self.dist_dir, MANIFEST_NAME), json.dumps(self.manifest, indent=2, sort_keys=True).encode("utf-8"))
+        return self.manifest
+
+
+def load_manifest(dist_dir):
+    try:
+        with open(os.path.join(dist_dir, MANIFEST_NAME), encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+# лучший заранее сжатый вариант, который принимает клиент: (путь, Content-Encoding)
+def pick_encoding(path, accept_encodings):
+    for encoding, suffix in ENCODINGS:
+        if accept_encodings[encoding] and os.path.isfile(path + suffix):
+            return path + suffix, encoding
+    return path, None
@@ -0,0 +1,208 @@
+# замер основных страниц через тестовый клиент Flask: задержки p50/p95/p99,
+# число SQL-запросов на запрос и пиковая память; каждая страница замеряется без кэша
+# готового HTML (cold - полная цена запросов и рендера) и с ним (warm); результат
+# сохраняется в JSON, чтобы сравнивать прогоны на SQLite и Postgres между коммитами;
+# замер голосует и добавляет фото, поэтому запускать его нужно на отдельной базе:
+#   python seed.py --database-uri sqlite:///bench.db --users 2000 --photos 5000 --votes 200000
+#   python benchmark.py --database-uri sqlite:///bench.db --output bench-sqlite.json
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import click
+from PIL import Image, ImageDraw
+from sqlalchemy import event
+
+from seed import SEED_PASSWORD
+
+UPLOAD_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "images", "pic01.jpg")
+# размер загружаемого фото, как у ссылок из seed.py
+UPLOAD_SIZE = (1600, 1067)
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+class Benchmark:
+    def __init__(self, app, db, models, rng):
+        self.app = app
+        self.db = db
+        self.User, self.Photo = models
+        self.rng = rng
+        self.anonymous = app.test_client()
+        self.logged_in = app.test_client()
+        with app.app_context():
+            self.queries = QueryCounter(db.engine)
+            self.photo_ids = [photo_id for photo_id, in db.session.query(self.Photo.id)]
+            self.user = db.session.query(self.User).filter(self.User.email.like("seed-%")).first()
+            if self.user is None or not self.photo_ids:
+                raise click.ClickException("в базе нет данных seed.py")
+            self.user_email = self.user.email
+        with Image.open(UPLOAD_IMAGE) as image:
+            self.upload_base = image.convert("RGB").resize(UPLOAD_SIZE)
+        self._login(self.logged_in)
+
+    def _login(self, client):
+        return client.post("/login", data={"email": self.user_email, "password": SEED_PASSWORD})
+
+    # каждый раз новое фото: копии кэшируются по хэшу файла, и одинаковая загрузка
+    # после первого раза замеряла бы только попадание в кэш
+    def _upload(self):
+        image = self.upload_base.copy()
+        x, y = self.rng.randrange(UPLOAD_SIZE[0] - 100), self.rng.randrange(UPLOAD_SIZE[1] - 100)
+        color = tuple(self.rng.randrange(256) for _ in range(3))
+        ImageDraw.Draw(image).rectangle((x, y, x + 100, y + 100), fill=color)
+        upload = io.BytesIO()
+        image.save(upload, "JPEG", quality=90)
+        upload.seek(0)
+        return upload
+
+    # сценарии: имя -> функция, выполняющая один запрос
+    def scenarios(self):
+        def feed():
+            return self.anonymous.get("/")
+
+        def photo():
+            return self.logged_in.get("/photo", query_string={"photo_id": self.rng.choice(self.photo_ids)})
+
+        def vote():
+            return self.logged_in.get("/vote", query_string={"photo_id": self.rng.choice(self.photo_ids)})
+
+        def login():
+            return self._login(self.app.test_client())
+
+        def new_photo():
+            return self.logged_in.post("/new-photo", content_type="multipart/form-data", data={
+                "photo_title": "Замер", "photo_place": "benchmark", "img_file": (self._upload(), "benchmark.jpg"),
+            })
+
+        return {"/": feed, "/photo": photo, "/vote": vote, "/login": login, "/new-photo": new_photo}
+
+    def run(self, name, request, requests, warmup, memory_samples):
+        for _ in range(warmup):
+            request().close()
+        latencies, queries = [], []
+        for _ in range(requests):
+            self.queries.count = 0
+            started = time.perf_counter()
+            response = request()
+            latencies.append((time.perf_counter() - started) * 1000)
+            queries.append(self.queries.count)
+            if response.status_code >= 400:
+                raise click.ClickException(f"{name}: ответ {response.status_code}")
+            response.close()
+        # память меряется отдельно: tracemalloc сильно замедляет запросы
+        peak = 0
+        tracemalloc.start()
+        for _ in range(memory_samples):
+            tracemalloc.reset_peak()
+            request().close()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        return {
+            "requests": requests,
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "mean_ms": round(sum(latencies) / len(latencies), 3),
+            "queries_mean": round(sum(queries) / len(queries), 2),
+            "queries_max": max(queries),
+            "peak_memory_kb": round(peak / 1024, 1),
+        }
+
+
+@click.command()
+@click.option("--database-uri", help="Адрес базы с данными seed.py, по умолчанию - база приложения")
+@click.option("--requests", default=200, show_default=True, help="Запросов на каждую страницу")
+@click.option("--warmup", default=10, show_default=True)
+@click.option("--memory-samples", default=20, show_default=True)
+@click.option("--route", "routes", multiple=True, help="Замерить только эти страницы (можно несколько раз)")
+@click.option("--cache-mode", "cache_modes", multiple=True, type=click.Choice(["cold", "warm"]),
+              help="cold - без кэша готового HTML, warm - с ним; по умолчанию оба")
+@click.option("--random-seed", default=0, show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False), help="Куда сохранить JSON, по умолчанию - вывод на экран")
+def benchmark_command(database_uri, requests, warmup, memory_samples, routes, cache_modes, random_seed, output):
+    import main
+    from main import app, db, User, Photo
+    work_dir = tempfile.mkdtemp(prefix="benchmark-")
+    if database_uri:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+    # загрузки и копии фото пишутся во временную папку, а не в static
+    app.config.update(WTF_CSRF_ENABLED=False, SECRET_KEY=app.config["SECRET_KEY"] or "benchmark",
+                      UPLOAD_FOLDER=os.path.join(work_dir, "uploads"))
+    main.image_pipeline.cache_dir = os.path.join(work_dir, "image_cache")
+    # время жизни кэша для каждого режима; warm - как в приложении
+    ttls = {"cold": 0, "warm": main.fragment_cache.ttl or 300}
+    cache_modes = [mode for mode in ttls if mode in (cache_modes or ttls)]
+
+    bench = Benchmark(app, db, (User, Photo), random.Random(random_seed))
+    scenarios = bench.scenarios()
+    unknown = set(routes) - set(scenarios)
+    if unknown:
+        raise click.BadParameter(f"неизвестные страницы: {', '.join(sorted(unknown))}", param_hint="--route")
+    results = {}
+    for name, request in scenarios.items():
+        if routes and name not in routes:
+            continue
+        results[name] = {}
+        for mode in cache_modes:
+            click.echo(f"{name} ({mode})...", err=True)
+            main.fragment_cache.ttl = ttls[mode]
+            results[name][mode] = bench.run(name, request, requests, warmup, memory_samples)
+    main.image_pipeline.shutdown()
+
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        rows = {model.__tablename__: db.session.query(model).count() for model in (User, Photo, main.Vote, main.Comment)}
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "database": dialect,
+            "rows": rows,
+            "fragment_cache_modes": cache_modes,
+            "fragment_cache_ttl": ttls["warm"],
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+        "routes": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as output_file:
+            output_file.write(text + "\n")
+    else:
+        click.echo(text)
+
+
+if __name__ == "__main__":
+    benchmark_command()
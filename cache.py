@@ -0,0 +1,118 @@
+# кэш готовых кусков HTML (лента, плитки фото, описание фото)
+# по умолчанию хранится в памяти процесса; для нескольких воркеров gunicorn нужен общий Redis,
+# иначе сброс кэша виден только в своем воркере (main.py тогда сокращает время жизни записей)
+import threading
+import time
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+
+# LRU в памяти процесса с временем жизни записей
+class LRUBackend:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # версии не вытесняются: иначе после сброса версии ожили бы старые записи
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def version(self, name):
+        with self._lock:
+            return self._versions.get(name, 0)
+
+    def bump(self, name):
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+
+# общий кэш в Redis (нужен пакет redis); вытеснение - по maxmemory-policy самого Redis
+class RedisBackend:
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("для FRAGMENT_CACHE_URL=redis://... нужен пакет redis")
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.setex(key, ttl, value)
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*keys)
+
+    def version(self, name):
+        return int(self._client.get(f"version:{name}") or 0)
+
+    def bump(self, name):
+        self._client.incr(f"version:{name}")
+
+
+def make_backend(url=None, max_entries=1024):
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    return LRUBackend(max_entries)
+
+
+class FragmentCache:
+    # ttl=0 выключает кэш: все куски рендерятся заново
+    def __init__(self, backend, ttl=300, prefix="fragments:"):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        if not self.ttl:
+            return None
+        return self.backend.get(self.prefix + key)
+
+    def set(self, key, value):
+        if self.ttl:
+            self.backend.set(self.prefix + key, value, self.ttl)
+
+    # взять кусок HTML из кэша или отрендерить и сохранить
+    def get_or_render(self, key, render):
+        value = self.get(key)
+        if value is None:
+            value = str(render())
+            self.set(key, value)
+        return Markup(value)
+
+    def invalidate(self, *keys):
+        self.backend.delete(*(self.prefix + key for key in keys))
+
+    # группа ключей с общей версией (например, все страницы ленты) сбрасывается одним увеличением
+    def version(self, name):
+        return self.backend.version(self.prefix + name)
+
+    def bump(self, name):
+        self.backend.bump(self.prefix + name)
@@ -1,15 +1,31 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, SubmitField, PasswordField
-from wtforms.validators import DataRequired, URL
+from wtforms.validators import DataRequired, URL, Optional, ValidationError
 from flask_ckeditor import CKEditorField
 
 ##WTForm
 class AddPhotoForm(FlaskForm):
     photo_title = StringField("Название", validators=[DataRequired()])
     photo_place = StringField("Где сделано фото", validators=[DataRequired()])
-    img_url = StringField("Ссылка URL на фото", validators=[DataRequired(), URL()])
+    img_url = StringField("Ссылка URL на фото", validators=[Optional(), URL()])
+    img_file = FileField("Или загрузите файл", validators=[FileAllowed(["jpg", "jpeg", "png", "webp"], "Только изображения")])
     submit = SubmitField("Добавить фото!")
 
+    # по ссылке сервер сам скачивает фото, поэтому принимаются только http(s)
+    def validate_img_url(self, field):
+        if field.data and not field.data.lower().startswith(("http://", "https://")):
+            raise ValidationError("Ссылка должна начинаться с http:// или https://")
+
+    # нужна либо ссылка, либо файл
+    def validate(self, extra_validators=None):
+        if not super().validate(extra_validators):
+            return False
+        if not self.img_url.data and not self.img_file.data:
+            self.img_url.errors.append("Укажите ссылку на фото или загрузите файл")
+            return False
+        return True
+
 class EditPhotoForm(FlaskForm):
     photo_title = StringField("Название", validators=[DataRequired()])
     photo_place = StringField("Где сделано фото", validators=[DataRequired()])
@@ -0,0 +1,226 @@
+# обработка фото: уменьшенные копии (плитка, страница фото, полный размер),
+# размытая заглушка и кэш на диске, адресуемый по хэшу исходного файла
+import base64
+import hashlib
+import io
+import ipaddress
+import os
+import shutil
+import socket
+import urllib.parse
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps, features
+
+# варианты размера: имя -> ширина в пикселях
+VARIANTS = {
+    "tile": 640,
+    "detail": 1280,
+    "full": 2048,
+}
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+PLACEHOLDER_WIDTH = 16
+# WebP делаем только если Pillow собран с его поддержкой
+FORMATS = ("webp", "jpg") if features.check("webp") else ("jpg",)
+MIME_TYPES = {"webp": "image/webp", "jpg": "image/jpeg"}
+
+FETCH_TIMEOUT = 20
+MAX_SOURCE_BYTES = 30 * 1024 * 1024
+
+
+class ImageError(Exception):
+    pass
+
+
+# ссылку на фото присылает пользователь, поэтому сервер не ходит по ней во внутреннюю сеть:
+# все адреса хоста (и каждого перенаправления) должны быть публичными
+def check_public_url(url):
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ImageError(f"неподдерживаемая ссылка {url}")
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        addresses = socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)
+    except (OSError, ValueError) as error:
+        raise ImageError(f"не удалось найти адрес {parts.hostname}: {error}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split("%")[0])
+        if getattr(ip, "ipv4_mapped", None):
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ImageError(f"ссылка {url} ведет на непубличный адрес {ip}")
+
+
+class _PublicRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_public_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib.request.build_opener(_PublicRedirectHandler)
+
+
+# стандартный способ получить исходник: http(s) по сети или файл из /static приложения
+# (загруженные фото лежат в /static/uploads); других ссылок нет, file:// не поддерживается
+def fetch_source(url, root_path="."):
+    if url.startswith(("http://", "https://")):
+        check_public_url(url)
+        request = urllib.request.Request(url, headers={"User-Agent": "north-photos"})
+        try:
+            with _opener.open(request, timeout=FETCH_TIMEOUT) as response:
+                data = response.read(MAX_SOURCE_BYTES + 1)
+        except OSError as error:
+            raise ImageError(f"не удалось скачать {url}: {error}")
+    elif url.startswith(("/static/", "static/")):
+        root = os.path.realpath(os.path.join(root_path, "static"))
+        path = os.path.realpath(os.path.join(root_path, url.lstrip("/")))
+        if os.path.commonpath([root, path]) != root:
+            raise ImageError(f"путь {url} вне папки static")
+        try:
+            with open(path, "rb") as source_file:
+                data = source_file.read(MAX_SOURCE_BYTES + 1)
+        except OSError as error:
+            raise ImageError(f"не удалось прочитать {path}: {error}")
+    else:
+        raise ImageError(f"неподдерживаемая ссылка {url}")
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ImageError(f"файл {url} больше {MAX_SOURCE_BYTES} байт")
+    return data
+
+
+# только форматы фото: расширение файла ничего не говорит о его содержимом
+SOURCE_FORMATS = ["JPEG", "PNG", "WEBP"]
+
+
+def _open(source):
+    try:
+        image = Image.open(io.BytesIO(source), formats=SOURCE_FORMATS)
+        image = ImageOps.exif_transpose(image)
+        return image.convert("RGB")
+    except (OSError, Image.DecompressionBombError) as error:
+        raise ImageError(f"не удалось открыть изображение: {error}")
+
+
+def _encode(image, fmt):
+    buffer = io.BytesIO()
+    if fmt == "webp":
+        image.save(buffer, "WEBP", quality=WEBP_QUALITY, method=4)
+    else:
+        image.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+# выполняется в отдельном процессе: исходник декодируется один раз, из него получаются
+# размер, крошечная заглушка в base64 и (если их еще нет в кэше) все варианты во всех форматах;
+# варианты уменьшаются от большего к меньшему, каждый из предыдущего, заглушка - из самого маленького
+def _render(source, with_variants):
+    image = _open(source)
+    width = image.width
+    variants = {}
+    if with_variants:
+        for name, variant_width in sorted(VARIANTS.items(), key=lambda item: -item[1]):
+            if image.width > variant_width:
+                image = image.resize((variant_width, round(image.height * variant_width / image.width)), Image.LANCZOS)
+            variants[name] = {fmt: _encode(image, fmt) for fmt in FORMATS}
+    image.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH * 4))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=40)
+    placeholder = "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+    return width, placeholder, variants
+
+
+class ProcessedImage:
+    def __init__(self, digest, width, placeholder):
+        self.digest = digest
+        self.width = width
+        self.placeholder = placeholder
+
+
+class ImagePipeline:
+    # fetch - функция url -> bytes, ее можно подменить (например, на чтение локальных файлов)
+    def __init__(self, cache_dir, fetch=fetch_source, max_cache_bytes=2 * 1024 ** 3, workers=None):
+        self.cache_dir = cache_dir
+        self.fetch = fetch
+        self.max_cache_bytes = max_cache_bytes
+        self.workers = workers
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def variant_dir(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def variant_path(self, digest, name, fmt):
+        return os.path.join(self.variant_dir(digest), f"{name}.{fmt}")
+
+    # скачать исходник один раз и обработать
+    def process_url(self, url):
+        return self.process(self.fetch(url))
+
+    # обработать исходник одной задачей в пуле процессов и сложить варианты в кэш
+    def process(self, source):
+        digest = hashlib.sha256(source).hexdigest()
+        cached = all(os.path.exists(self.variant_path(digest, name, fmt)) for name in VARIANTS for fmt in FORMATS)
+        try:
+            width, placeholder, variants = self.pool.submit(_render, source, not cached).result()
+        except BrokenProcessPool as error:
+            # процесс пула убит (нехватка памяти, падение декодера): пул пересоздается при следующем фото
+            self._pool = None
+            raise ImageError(f"процесс обработки фото завершился аварийно: {error}")
+        if variants:
+            os.makedirs(self.variant_dir(digest), exist_ok=True)
+            for name, encoded in variants.items():
+                for fmt, data in encoded.items():
+                    self._write(self.variant_path(digest, name, fmt), data)
+            self.evict(keep=digest)
+        return ProcessedImage(digest, width, placeholder)
+
+    @staticmethod
+    def _write(path, data):
+        # запись через временный файл, чтобы параллельный запрос не отдал недописанный файл
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as variant_file:
+            variant_file.write(data)
+        os.replace(temporary, path)
+
+    # отметить использование варианта, чтобы вытеснялись давно не нужные
+    def touch(self, digest):
+        try:
+            os.utime(self.variant_dir(digest))
+        except OSError:
+            pass
+
+    # удалить самые давно использованные фото, пока кэш больше лимита
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        if not os.path.isdir(self.cache_dir):
+            return
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for digest in os.listdir(prefix_dir):
+                directory = os.path.join(prefix_dir, digest)
+                size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+                entries.append((os.stat(directory).st_mtime, size, digest, directory))
+                total += size
+        for _, size, digest, directory in sorted(entries):
+            if total <= self.max_cache_bytes:
+                break
+            if digest == keep:
+                continue
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
@@ -1,18 +1,31 @@
-import random
-
-from flask import Flask, render_template, redirect, url_for, flash, abort, request
+from flask import Flask, render_template, redirect, url_for, flash, abort, request, jsonify, send_file
+from markupsafe import Markup
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
-from datetime import date
+from datetime import date, datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
-from sqlalchemy import Table, Column, Integer, ForeignKey
+from sqlalchemy.orm import relationship, joinedload
+from sqlalchemy import Table, Column, Integer, ForeignKey, or_, and_, func
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects import postgresql, sqlite
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from forms import AddPhotoForm, RegisterForm, LoginForm, CommentForm, EditPhotoForm
-from functools import wraps
+from functools import wraps, partial
+from assets import AssetBuilder, load_manifest, pick_encoding
+from metrics import RequestMetrics
+from search import search_photo_ids
+from images import ImagePipeline, ImageError, fetch_source, VARIANTS, FORMATS, MIME_TYPES
+from cache import FragmentCache, LRUBackend, make_backend
+import hashlib
+import mimetypes
+import json
+import migrations
+from write_behind import WriteBehindQueue
 import os
+import re
+import click
 
 #конфигурация
 login_manager=LoginManager()
@@ -29,6 +42,38 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL.replace('po
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
+# кэш уменьшенных копий фото и папка для загруженных оригиналов
+app.config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR', os.path.join(app.root_path, 'image_cache'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static', 'uploads')
+image_pipeline = ImagePipeline(
+    app.config['IMAGE_CACHE_DIR'],
+    fetch=partial(fetch_source, root_path=app.root_path),
+    max_cache_bytes=app.config['IMAGE_CACHE_MAX_BYTES'],
+)
+
+# кэш готовых кусков HTML: в памяти процесса или общий (FRAGMENT_CACHE_URL=redis://...)
+# кэш в памяти сбрасывается только в том воркере gunicorn, который обработал голос или правку,
+# поэтому при нескольких воркерах (WEB_CONCURRENCY > 1) без общего кэша записи живут лишь
+# FRAGMENT_CACHE_LOCAL_TTL секунд - дольше остальные воркеры показывали бы устаревшие фото
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL')
+app.config['FRAGMENT_CACHE_MAX_ENTRIES'] = int(os.environ.get('FRAGMENT_CACHE_MAX_ENTRIES', 1024))
+app.config['FRAGMENT_CACHE_LOCAL_TTL'] = int(os.environ.get('FRAGMENT_CACHE_LOCAL_TTL', 5))
+fragment_cache_backend = make_backend(app.config['FRAGMENT_CACHE_URL'], app.config['FRAGMENT_CACHE_MAX_ENTRIES'])
+app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+if isinstance(fragment_cache_backend, LRUBackend) and int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+    app.config['FRAGMENT_CACHE_TTL'] = min(app.config['FRAGMENT_CACHE_TTL'], app.config['FRAGMENT_CACHE_LOCAL_TTL'])
+fragment_cache = FragmentCache(fragment_cache_backend, ttl=app.config['FRAGMENT_CACHE_TTL'])
+
+# собранная статика с хэшами в именах (flask build-assets); без сборки ссылки ведут на обычный /static
+app.config['ASSETS_DIR'] = os.path.join(app.static_folder, 'dist')
+asset_manifest = load_manifest(app.config['ASSETS_DIR'])
+
+# замеры запросов, Server-Timing и /metrics (METRICS_ENABLED=1); выключенные ничего не стоят
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED') == '1'
+app.config['METRICS_N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('METRICS_N_PLUS_ONE_THRESHOLD', 5))
+request_metrics = RequestMetrics(app)
+
 
 #Конфигурация баз данных
 
@@ -52,10 +97,18 @@ class Photo(db.Model):
     photo_author = relationship("User", back_populates="photos")
     photo_title = db.Column(db.String(250), nullable=False)
     photo_place = db.Column(db.String(500), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
     img_url = db.Column(db.String(250), nullable=False)
     comments = relationship("Comment", back_populates="parent_photo")
-    votes = relationship("Vote", back_populates="parent_photo")
+    # голоса удаляются одним DELETE в delete_photo, поэтому при удалении фото они не загружаются
+    votes = relationship("Vote", back_populates="parent_photo", cascade="all, delete-orphan", passive_deletes=True)
+    # число голосов хранится в самой строке фото, чтобы лента сортировалась в SQL
+    vote_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # хэш исходника в кэше уменьшенных копий, его ширина и размытая заглушка
+    img_hash = db.Column(db.String(64), index=True)
+    img_width = db.Column(db.Integer)
+    img_placeholder = db.Column(db.Text)
+    __table_args__ = (db.Index("ix_photos_vote_count_id", "vote_count", "id"),)
 
 class Comment(db.Model):
     __tablename__ = 'comments'
@@ -74,37 +127,434 @@ class Vote(db.Model):
     photo_id = Column(Integer, ForeignKey('photos.id'))
     parent_photo = relationship("Photo", back_populates="votes")
     like = db.Column(Integer())
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # один голос пользователя за фото; второй индекс - для выборки проголосовавших по фото
+    __table_args__ = (
+        db.Index("uq_votes_author_id_photo_id", "author_id", "photo_id", unique=True),
+        db.Index("ix_votes_photo_id_author_id", "photo_id", "author_id"),
+    )
+
+# рейтинг фото за месяц: число голосов, отданных за фото в этом месяце;
+# строится заранее командой flask build-leaderboards
+class LeaderboardEntry(db.Model):
+    __tablename__ = 'leaderboard'
+    month = db.Column(db.String(7), primary_key=True)
+    photo_id = Column(Integer, ForeignKey('photos.id', ondelete="CASCADE"), primary_key=True)
+    photo = relationship("Photo")
+    votes = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index("ix_leaderboard_month_votes", "month", "votes"),)
+
+# когда начался прошлый пересчет рейтингов
+class LeaderboardState(db.Model):
+    __tablename__ = 'leaderboard_state'
+    id = db.Column(db.Integer, primary_key=True)
+    built_at = db.Column(db.DateTime)
 
 
 # db.create_all()
 
+# создать недостающие таблицы и применить миграции: flask upgrade-db
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    db.create_all()
+    migrations.upgrade(db.engine)
+
+# пересчитать число голосов у всех фото: flask backfill-vote-counts
+@app.cli.command("backfill-vote-counts")
+def backfill_vote_counts():
+    with db.engine.begin() as conn:
+        migrations.backfill_vote_counts(conn)
+
 #логин_менеджер
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
-#загрузить домашнюю страницу со всеми фото
+# статика
+
+# как url_for('static', filename=...), но на версию с хэшем, если статика собрана
+@app.template_global()
+def asset_url(filename):
+    if filename in asset_manifest:
+        return url_for('asset', filename=asset_manifest[filename])
+    return url_for('static', filename=filename)
+
+# собранная статика: сжатый вариант по Accept-Encoding, кэш навсегда, 304 по ETag;
+# в продакшене эту папку может отдавать и nginx/CDN (gzip_static/brotli_static) без Python
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    path = safe_join(app.config['ASSETS_DIR'], filename)
+    if path is None or not os.path.isfile(path) or path.endswith(('.gz', '.br')):
+        abort(404)
+    path, encoding = pick_encoding(path, request.accept_encodings)
+    # имя уже содержит хэш содержимого, поэтому ETag - имя плюс сжатие
+    etag = f"{filename}.{encoding}" if encoding else filename
+    # If-None-Match сравнивается слабо (RFC 7232): прокси, пережимающие ответ, присылают W/"..."
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_file(path, mimetype=mimetype, etag=False, conditional=False, max_age=365 * 24 * 3600)
+        if encoding:
+            response.content_encoding = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
+
+# собрать статику: flask build-assets
+@app.cli.command("build-assets")
+def build_assets():
+    manifest = AssetBuilder(app.static_folder, app.config['ASSETS_DIR']).build()
+    click.echo(f"собрано файлов: {len(manifest)}")
+
+# уменьшенные копии фото
+
+def set_photo_image(photo, processed):
+    photo.img_hash = processed.digest
+    photo.img_width = processed.width
+    photo.img_placeholder = processed.placeholder
+
+# сделать уменьшенные копии для фото; если исходник недоступен, остается оригинальная ссылка
+def process_photo_image(photo):
+    try:
+        processed = image_pipeline.process_url(photo.img_url)
+    except ImageError as error:
+        app.logger.warning("photo %s: %s", photo.id, error)
+        return False
+    set_photo_image(photo, processed)
+    return True
+
+@app.template_global()
+def photo_image_url(photo, name, fmt="jpg"):
+    if not photo.img_hash:
+        return photo.img_url
+    return url_for('photo_image', digest=photo.img_hash, filename=f"{name}.{fmt}")
+
+# srcset из всех вариантов; копии не бывают шире исходника
+@app.template_global()
+def photo_srcset(photo, fmt="jpg"):
+    if not photo.img_hash or fmt not in FORMATS:
+        return ""
+    widths = {}
+    for name, width in VARIANTS.items():
+        widths.setdefault(min(width, photo.img_width or width), name)
+    return ", ".join(f"{photo_image_url(photo, name, fmt)} {width}w" for width, name in sorted(widths.items()))
+
+# отдать вариант из кэша; если его вытеснили - сделать заново из оригинала
+@app.route('/images/<digest>/<filename>')
+def photo_image(digest, filename):
+    name, _, fmt = filename.partition(".")
+    if not re.fullmatch(r"[0-9a-f]{64}", digest) or name not in VARIANTS or fmt not in FORMATS:
+        abort(404)
+    path = image_pipeline.variant_path(digest, name, fmt)
+    if not os.path.exists(path):
+        photo = Photo.query.filter_by(img_hash=digest).first()
+        if photo is None or not process_photo_image(photo) or photo.img_hash != digest:
+            abort(404)
+    image_pipeline.touch(digest)
+    response = send_file(path, mimetype=MIME_TYPES[fmt], max_age=365 * 24 * 3600)
+    response.cache_control.immutable = True
+    return response
+
+# сделать уменьшенные копии для существующих фото: flask build-image-variants [--all]
+@app.cli.command("build-image-variants")
+@click.option("--all", "rebuild_all", is_flag=True, help="Обработать и фото, у которых копии уже есть")
+def build_image_variants(rebuild_all):
+    query = Photo.query if rebuild_all else Photo.query.filter(Photo.img_hash.is_(None))
+    for photo in query.order_by(Photo.id).all():
+        if process_photo_image(photo):
+            db.session.commit()
+            fragment_cache.invalidate(f"tile:{photo.id}")
+            click.echo(f"{photo.id}: {photo.img_hash}")
+        else:
+            click.echo(f"{photo.id}: пропущено")
+    image_pipeline.shutdown()
+
+# размер страницы ленты и максимальный размер страницы для API
+FEED_PAGE_SIZE = 12
+FEED_MAX_PAGE_SIZE = 50
+
+# курсор ленты - пара (число голосов, id) последнего показанного фото
+def encode_cursor(photo):
+    return f"{photo.vote_count}.{photo.id}"
+
+def decode_cursor(cursor):
+    try:
+        vote_count, photo_id = cursor.split(".")
+        return int(vote_count), int(photo_id)
+    except ValueError:
+        abort(400)
+
+# одна страница ленты по ключу (vote_count, id) без OFFSET: база идет по индексу
+# ix_photos_vote_count_id сразу с нужного места, поэтому скорость не зависит от номера страницы
+def get_feed_page(after=None, limit=FEED_PAGE_SIZE):
+    query = Photo.query.order_by(Photo.vote_count.desc(), Photo.id.desc())
+    if after:
+        vote_count, photo_id = decode_cursor(after)
+        query = query.filter(or_(
+            Photo.vote_count < vote_count,
+            and_(Photo.vote_count == vote_count, Photo.id < photo_id),
+        ))
+    # лишняя запись нужна только чтобы узнать, есть ли следующая страница
+    photos = query.limit(limit + 1).all()
+    next_cursor = encode_cursor(photos[limit - 1]) if len(photos) > limit else None
+    return photos[:limit], next_cursor
+
+# кэш: страница ленты хранится как список id фото, а каждая плитка - отдельно,
+# поэтому правка описания сбрасывает только плитку, а голос - плитку и порядок ленты
+
+# сбросить куски HTML, в которых показано фото
+def invalidate_photo_fragments(photo_id, feed_order_changed=True):
+    fragment_cache.invalidate(f"tile:{photo_id}", f"details:{photo_id}")
+    if feed_order_changed:
+        fragment_cache.bump("feed")
+
+def render_tile(photo):
+    return fragment_cache.get_or_render(f"tile:{photo.id}", lambda: render_template("photo_tile.html", photo=photo))
+
+# плитки страницы ленты; при полном попадании в кэш база не запрашивается вовсе
+def get_feed_tiles(after=None):
+    feed_key = f"feed:{fragment_cache.version('feed')}:{after or ''}"
+    cached_page = fragment_cache.get(feed_key)
+    if cached_page is None:
+        photos, next_cursor = get_feed_page(after)
+        fragment_cache.set(feed_key, json.dumps({"ids": [photo.id for photo in photos], "next": next_cursor}))
+        return [render_tile(photo) for photo in photos], next_cursor
+    cached_page = json.loads(cached_page)
+    tiles = {photo_id: fragment_cache.get(f"tile:{photo_id}") for photo_id in cached_page["ids"]}
+    missing = [photo_id for photo_id, tile in tiles.items() if tile is None]
+    if missing:
+        for photo in Photo.query.filter(Photo.id.in_(missing)):
+            tiles[photo.id] = render_tile(photo)
+    # фото, удаленные после кэширования страницы, просто пропускаются
+    return [Markup(tiles[photo_id]) for photo_id in cached_page["ids"] if tiles[photo_id] is not None], cached_page["next"]
+
+#загрузить домашнюю страницу с первой страницей ленты
 @app.route('/')
 def get_all_photos():
-    photos = Photo.query.all()
-    return render_template("index.html" , photos = sorted(photos, key=lambda photo: len(photo.votes), reverse=True))
+    tiles, next_cursor = get_feed_tiles(request.args.get('after'))
+    return render_template("index.html" , tiles = tiles, next_cursor = next_cursor)
+
+# фото в JSON для API
+def photo_to_json(photo):
+    return {
+        "id": photo.id,
+        "photo_title": photo.photo_title,
+        "photo_place": photo.photo_place,
+        "img_url": photo.img_url,
+        "tile_url": photo_image_url(photo, "tile"),
+        "srcset": photo_srcset(photo),
+        "vote_count": photo.vote_count,
+        "url": url_for('view_photo', photo_id=photo.id),
+    }
+
+def get_page_limit():
+    limit = request.args.get('limit', FEED_PAGE_SIZE, type=int)
+    return max(1, min(limit, FEED_MAX_PAGE_SIZE))
+
+# следующая страница ленты в JSON для бесконечной прокрутки
+@app.route('/api/photos')
+def api_photos():
+    photos, next_cursor = get_feed_page(request.args.get('after'), get_page_limit())
+    return jsonify(photos=[photo_to_json(photo) for photo in photos], next=next_cursor)
+
+# поиск
+
+# страница результатов поиска по релевантности и признак, есть ли следующая
+def search_photos(query, page, limit=FEED_PAGE_SIZE):
+    photo_ids = search_photo_ids(db.session.connection(), query, limit + 1, (page - 1) * limit)
+    photos = {photo.id: photo for photo in Photo.query.filter(Photo.id.in_(photo_ids[:limit]))}
+    return [photos[photo_id] for photo_id in photo_ids[:limit] if photo_id in photos], len(photo_ids) > limit
+
+def get_search_args():
+    return request.args.get('q', '').strip(), max(request.args.get('page', 1, type=int), 1)
+
+# поиск фото по названию, месту, автору и филиалу
+@app.route('/search')
+def search():
+    query, page = get_search_args()
+    photos, has_next = search_photos(query, page) if query else ([], False)
+    return render_template("search.html", query=query, page=page, has_next=has_next,
+                           tiles=[render_tile(photo) for photo in photos])
+
+# то же в JSON
+@app.route('/api/search')
+def api_search():
+    query, page = get_search_args()
+    photos, has_next = search_photos(query, page, get_page_limit()) if query else ([], False)
+    return jsonify(photos=[photo_to_json(photo) for photo in photos], next_page=page + 1 if has_next else None)
+
+# голоса
+
+# INSERT ... ON CONFLICT DO NOTHING есть и в SQLite, и в Postgres
+INSERT_DIALECTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+# строк в одном INSERT: старые SQLite ограничивают запрос 999 параметрами
+VOTES_PER_INSERT = 300
+
+# записать голоса (пользователь, фото, время) одной транзакцией; повторные голоса пропускаются
+# уникальным индексом, а счетчик фото увеличивается ровно на число действительно добавленных строк;
+# голоса за фото, удаленные, пока голос ждал в очереди, отбрасываются
+def insert_votes(votes):
+    insert = INSERT_DIALECTS[db.engine.dialect.name]
+    voters_by_photo = {}
+    for author_id, photo_id, created_at in votes:
+        voters = voters_by_photo.setdefault(photo_id, {})
+        voters[author_id] = min(created_at, voters.get(author_id, created_at))
+    existing = {photo_id for photo_id, in db.session.query(Photo.id).filter(Photo.id.in_(list(voters_by_photo)))}
+    voters_by_photo = {photo_id: voters for photo_id, voters in voters_by_photo.items() if photo_id in existing}
+    changed_photos = []
+    for photo_id, voters in voters_by_photo.items():
+        voters = sorted(voters.items())
+        inserted = 0
+        for start in range(0, len(voters), VOTES_PER_INSERT):
+            statement = insert(Vote.__table__).values([
+                {"author_id": author_id, "photo_id": photo_id, "like": 1, "created_at": created_at}
+                for author_id, created_at in voters[start:start + VOTES_PER_INSERT]
+            ]).on_conflict_do_nothing(index_elements=["author_id", "photo_id"])
+            inserted += db.session.execute(statement).rowcount
+        if inserted:
+            db.session.query(Photo).filter_by(id=photo_id) \
+                .update({Photo.vote_count: Photo.vote_count + inserted}, synchronize_session=False)
+            changed_photos.append(photo_id)
+    db.session.commit()
+    for photo_id in changed_photos:
+        invalidate_photo_fragments(photo_id)
+    return changed_photos
+
+def flush_votes(votes):
+    with app.app_context():
+        insert_votes(votes)
+
+# отложенная запись голосов (VOTE_WRITE_BEHIND=1): голоса копятся в очереди и пишутся пачками,
+# при остановке воркера gunicorn очередь дописывается
+app.config['VOTE_WRITE_BEHIND'] = os.environ.get('VOTE_WRITE_BEHIND') == '1'
+app.config['VOTE_BATCH_SIZE'] = int(os.environ.get('VOTE_BATCH_SIZE', 500))
+app.config['VOTE_FLUSH_INTERVAL'] = float(os.environ.get('VOTE_FLUSH_INTERVAL', 1.0))
+app.config['VOTE_QUEUE_SIZE'] = int(os.environ.get('VOTE_QUEUE_SIZE', 10000))
+vote_queue = WriteBehindQueue(
+    flush_votes,
+    batch_size=app.config['VOTE_BATCH_SIZE'],
+    interval=app.config['VOTE_FLUSH_INTERVAL'],
+    max_size=app.config['VOTE_QUEUE_SIZE'],
+)
 
 #проголосовать за фото
 @app.route('/vote')
 def vote_for_photo():
+    if not current_user.is_authenticated:
+        return redirect(url_for('login'))
     # получить выбранное фото из базы данных
-    photo_id = request.args.get('photo_id')
-    requested_photo = Photo.query.get(photo_id)
-    # загрузить новый голос в базу
-    new_vote= Vote(
-        voting_user = current_user,
-        parent_photo = requested_photo,
-        like=1
-    )
-    db.session.add(new_vote)
-    db.session.commit()
+    photo_id = request.args.get('photo_id', type=int)
+    requested_photo = Photo.query.get_or_404(photo_id)
+    # загрузить новый голос в базу: сразу или через очередь, если она не переполнена
+    vote = (current_user.id, requested_photo.id, datetime.utcnow())
+    if not (app.config['VOTE_WRITE_BEHIND'] and vote_queue.put(vote)):
+        insert_votes([vote])
     return redirect(url_for('get_all_photos'))
 
+# рейтинги месяца
+
+# сколько фото показывать в рейтинге месяца, сколько строк обрабатывать за раз
+# и до скольких фото пересчитывать месяц выборочно, а не целиком
+LEADERBOARD_SIZE = 20
+LEADERBOARD_CHUNK = 500
+LEADERBOARD_PHOTOS_SELECTIVE = 500
+# голос виден после commit, а время у него - момента голосования (в очереди голос ждет до записи),
+# поэтому каждый пересчет заново смотрит голоса за этот запас до начала прошлого
+LEADERBOARD_LAG = timedelta(minutes=10)
+
+# начало месяца, сдвинутого на delta месяцев; None за пределами допустимых дат
+def shift_month(month_start, delta):
+    index = month_start.year * 12 + month_start.month - 1 + delta
+    year, month = divmod(index, 12)
+    if not 1 <= year <= 9999:
+        return None
+    return month_start.replace(year=year, month=month + 1, day=1)
+
+# месяц в виде "гггг-мм" (strftime не дополняет нулями годы меньше 1000)
+def month_key(month_start):
+    return f"{month_start.year:04d}-{month_start.month:02d}"
+
+# пересчитать рейтинги для месяцев и фото, за которые голосовали с прошлого запуска
+# сохраняется полное число голосов, поэтому повторный просмотр голосов ничего не удваивает
+def build_leaderboards():
+    started = datetime.utcnow()
+    insert = INSERT_DIALECTS[db.engine.dialect.name]
+    state = LeaderboardState.query.get(1)
+    if state is None:
+        state = LeaderboardState(id=1)
+        db.session.add(state)
+    new_votes = db.session.query(Vote.photo_id, Vote.created_at) \
+        .filter(Vote.photo_id.isnot(None), Vote.created_at.isnot(None))
+    # при первом запуске рейтинги строятся по всем голосам
+    if state.built_at is not None:
+        new_votes = new_votes.filter(Vote.created_at >= state.built_at - LEADERBOARD_LAG)
+    affected = {}
+    processed = 0
+    for photo_id, created_at in new_votes.yield_per(LEADERBOARD_CHUNK):
+        affected.setdefault(month_key(created_at), set()).add(photo_id)
+        processed += 1
+    for month, photo_ids in affected.items():
+        month_start = datetime.strptime(month, "%Y-%m")
+        month_end = shift_month(month_start, 1)
+        counts = db.session.query(Vote.photo_id, func.count(Vote.id)) \
+            .filter(Vote.created_at >= month_start) \
+            .group_by(Vote.photo_id)
+        if month_end is not None:
+            counts = counts.filter(Vote.created_at < month_end)
+        # немного фото - считаются только их голоса, иначе весь месяц одним проходом
+        if len(photo_ids) <= LEADERBOARD_PHOTOS_SELECTIVE:
+            counts = counts.filter(Vote.photo_id.in_(photo_ids))
+        rows = [{"month": month, "photo_id": photo_id, "votes": votes}
+                for photo_id, votes in counts if photo_id is not None]
+        for chunk_start in range(0, len(rows), LEADERBOARD_CHUNK):
+            statement = insert(LeaderboardEntry.__table__).values(rows[chunk_start:chunk_start + LEADERBOARD_CHUNK])
+            statement = statement.on_conflict_do_update(
+                index_elements=["month", "photo_id"],
+                set_={"votes": statement.excluded.votes},
+            )
+            db.session.execute(statement)
+    state.built_at = started
+    db.session.commit()
+    return processed
+
+# обновить рейтинги месяца (запускать по расписанию): flask build-leaderboards
+@app.cli.command("build-leaderboards")
+def build_leaderboards_command():
+    click.echo(f"обработано голосов: {build_leaderboards()}")
+
+# лучшие фото месяца из готового рейтинга
+@app.route('/leaderboard/<month>')
+def leaderboard(month):
+    if not re.fullmatch(r"\d{4}-\d{2}", month):
+        abort(404)
+    try:
+        month_start = datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        abort(404)
+    entries = LeaderboardEntry.query \
+        .options(joinedload(LeaderboardEntry.photo).joinedload(Photo.photo_author)) \
+        .join(Photo) \
+        .filter(LeaderboardEntry.month == month) \
+        .order_by(LeaderboardEntry.votes.desc(), LeaderboardEntry.photo_id) \
+        .limit(LEADERBOARD_SIZE) \
+        .all()
+    # у первого и последнего допустимого месяца нет соседа с одной стороны
+    previous_month = shift_month(month_start, -1)
+    next_month = shift_month(month_start, 1)
+    previous_month = month_key(previous_month) if previous_month else None
+    next_month = month_key(next_month) if next_month else None
+    return render_template("leaderboard.html", entries=entries, month_start=month_start,
+                           previous_month=previous_month, next_month=next_month)
+
+@app.template_global()
+def current_month():
+    # рейтинги разбиты по месяцам UTC-времени голосов
+    return month_key(datetime.utcnow())
+
 # войти на сайт под своей учетной записью
 @app.route('/login', methods=["POST", "GET"])
 def login():
@@ -162,6 +612,9 @@ def logout():
     logout_user()
     return redirect(url_for('get_all_photos'))
 
+# сколько проголосовавших показывать на странице фото
+VOTERS_SHOWN = 4
+
 # просмотр фото из ленты
 @app.route("/photo", methods=["GET", "POST"])
 def view_photo():
@@ -169,10 +622,25 @@ def view_photo():
     form = CommentForm()
     # получение из базы данных запрошенного фото
     photo_id = request.args.get('photo_id')
-    requested_photo = Photo.query.get(photo_id)
-    # перемешивание массива с проголосовавшими за фото пользователями
-    votes = sorted(requested_photo.votes, key=lambda voting_user: random.random())
-    return render_template("view_photo.html", photo=requested_photo, comment_form = form, votes = votes)
+    # автор фото загружается тем же запросом
+    requested_photo = Photo.query.options(joinedload(Photo.photo_author)).get_or_404(photo_id)
+    # описание фото берется из кэша; приветствие и кнопка голосования рендерятся для каждого пользователя
+    def render_details():
+        # несколько случайных проголосовавших выбираются в самой базе, без загрузки всех голосов
+        voters = db.session.query(User.first_name, User.last_name) \
+            .join(Vote, Vote.author_id == User.id) \
+            .filter(Vote.photo_id == requested_photo.id) \
+            .order_by(func.random()) \
+            .limit(VOTERS_SHOWN) \
+            .all()
+        return render_template("photo_details.html", photo=requested_photo, voters=voters)
+    details = fragment_cache.get_or_render(f"details:{requested_photo.id}", render_details)
+    # проверка голоса текущего пользователя - один запрос по индексу (photo_id, author_id)
+    user_already_voted = current_user.is_authenticated and db.session.query(
+        Vote.query.filter_by(photo_id=requested_photo.id, author_id=current_user.id).exists()
+    ).scalar()
+    return render_template("view_photo.html", photo=requested_photo, comment_form = form, details = details,
+                           user_already_voted = user_already_voted)
 
 # добавление нового фото
 @app.route("/new-photo", methods=["GET", "POST"])
@@ -181,15 +649,38 @@ def add_new_photo():
     form = AddPhotoForm()
     # добавление фото в базу данных
     if form.validate_on_submit():
+        img_url = form.img_url.data
+        processed = None
+        # загруженный файл сохраняется один раз под своим хэшем и дальше не скачивается;
+        # файл, который не открывается как фото, не сохраняется
+        if form.img_file.data:
+            source = form.img_file.data.read()
+            try:
+                processed = image_pipeline.process(source)
+            except ImageError as error:
+                app.logger.warning("upload %s: %s", form.img_file.data.filename, error)
+                form.img_file.errors.append("Не удалось открыть файл как фото (JPEG, PNG или WebP)")
+                return render_template("make-photo.html", form=form)
+            extension = os.path.splitext(form.img_file.data.filename)[1].lower()
+            filename = hashlib.sha256(source).hexdigest() + extension
+            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+            with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), "wb") as upload:
+                upload.write(source)
+            img_url = url_for('static', filename=f"uploads/{filename}")
         new_photo = Photo(
             photo_title=form.photo_title.data,
             photo_place=form.photo_place.data,
-            img_url=form.img_url.data,
+            img_url=img_url,
             photo_author=current_user,
-            date=date.today().strftime("%d.%m.%Y")
+            date=date.today()
         )
+        if processed:
+            set_photo_image(new_photo, processed)
+        else:
+            process_photo_image(new_photo)
         db.session.add(new_photo)
         db.session.commit()
+        fragment_cache.bump("feed")
         return redirect(url_for("get_all_photos"))
     return render_template("make-photo.html", form=form)
 
@@ -221,6 +712,7 @@ def edit_photo():
         photo_to_edit.photo_title = edit_form.photo_title.data
         photo_to_edit.photo_place = edit_form.photo_place.data
         db.session.commit()
+        invalidate_photo_fragments(photo_to_edit.id, feed_order_changed=False)
         return redirect(url_for("view_photo", photo_id=photo_to_edit.id))
 
     return render_template("make-photo.html", form=edit_form, is_edit=True)
@@ -232,9 +724,12 @@ def delete_photo():
     # запросить у базы данных фото для удаления
     photo_id = request.args.get('photo_id')
     photo_to_delete = Photo.query.get(photo_id)
-    # удалить запрошенное фото
+    # удалить запрошенное фото вместе с его голосами и местами в рейтингах, не загружая их
+    LeaderboardEntry.query.filter_by(photo_id=photo_to_delete.id).delete()
+    Vote.query.filter_by(photo_id=photo_to_delete.id).delete()
     db.session.delete(photo_to_delete)
     db.session.commit()
+    invalidate_photo_fragments(photo_to_delete.id)
     return redirect(url_for('get_all_photos'))
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+# замеры каждого запроса: число SQL-запросов и время в базе, время рендера шаблонов,
+# общее время; поиск N+1 (один и тот же SQL много раз за запрос), заголовок Server-Timing
+# и гистограммы по страницам в формате Prometheus на /metrics
+# при METRICS_ENABLED=0 ничего не подключается и /metrics не существует
+# гистограммы свои у каждого процесса: при нескольких воркерах gunicorn их складывает Prometheus
+import threading
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def export(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+# замеры одного запроса, хранятся в flask.g
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.render_depth = 0
+        self.statements = Counter()
+        self.total = None
+        self.status = 500
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RequestMetrics:
+    # (имя, описание, корзины) гистограмм по страницам
+    HISTOGRAMS = (
+        ("http_request_duration_seconds", "Общее время запроса", DURATION_BUCKETS),
+        ("http_request_sql_duration_seconds", "Время SQL-запросов за запрос", DURATION_BUCKETS),
+        ("http_request_render_duration_seconds", "Время рендера шаблонов за запрос", DURATION_BUCKETS),
+        ("http_request_sql_queries", "Число SQL-запросов за запрос", QUERY_BUCKETS),
+    )
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._requests = Counter()
+        self._n_plus_one = Counter()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("METRICS_ENABLED", False)
+        # одинаковый SQL больше стольких раз за запрос считается N+1
+        app.config.setdefault("METRICS_N_PLUS_ONE_THRESHOLD", 5)
+        if not app.config["METRICS_ENABLED"]:
+            return
+        self.app = app
+        event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._add_headers)
+        app.teardown_request(self._finish_request)
+        app.jinja_env.template_class = self._timed_template_class(app.jinja_env.template_class)
+        app.add_url_rule("/metrics", "metrics", self.export)
+
+    @staticmethod
+    def _stats():
+        if has_request_context():
+            return g.get("_request_stats")
+        return None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        stats = self._stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.sql_time += elapsed
+            stats.statements[statement] += 1
+
+    # время считается только у внешнего рендера, вложенные в него не прибавляются второй раз
+    def _timed_template_class(self, base):
+        stats = self._stats
+
+        class TimedTemplate(base):
+            def render(self, *args, **kwargs):
+                request_stats = stats()
+                if request_stats is None:
+                    return super().render(*args, **kwargs)
+                request_stats.render_depth += 1
+                started = time.perf_counter()
+                try:
+                    return super().render(*args, **kwargs)
+                finally:
+                    request_stats.render_depth -= 1
+                    if not request_stats.render_depth:
+                        request_stats.render_time += time.perf_counter() - started
+
+        return TimedTemplate
+
+    def _start_request(self):
+        g._request_stats = RequestStats()
+
+    # заголовки Server-Timing; для необработанных исключений after_request не вызывается,
+    # поэтому сами замеры записываются в teardown_request
+    def _add_headers(self, response):
+        stats = g.get("_request_stats")
+        if stats is None:
+            return response
+        stats.total = time.perf_counter() - stats.started
+        stats.status = response.status_code
+        response.headers.add("Server-Timing", f'db;dur={stats.sql_time * 1000:.2f};desc="{stats.queries} queries"')
+        response.headers.add("Server-Timing", f"render;dur={stats.render_time * 1000:.2f}")
+        response.headers.add("Server-Timing", f"total;dur={stats.total * 1000:.2f}")
+        return response
+
+    # запрос закончился ответом или ошибкой: без ответа он считается как 500
+    def _finish_request(self, exception):
+        stats = g.pop("_request_stats", None)
+        if stats is None:
+            return
+        total = stats.total if stats.total is not None else time.perf_counter() - stats.started
+        status = 500 if exception is not None else stats.status
+        endpoint = request.endpoint or "not_found"
+        repeated = [(statement, count) for statement, count in stats.statements.items()
+                    if count > self.app.config["METRICS_N_PLUS_ONE_THRESHOLD"]]
+        for statement, count in repeated:
+            self.app.logger.warning("N+1 на %s: %d раз %s", endpoint, count, " ".join(statement.split()))
+        with self._lock:
+            values = (total, stats.sql_time, stats.render_time, stats.queries)
+            for (name, _, buckets), value in zip(self.HISTOGRAMS, values):
+                self._histograms.setdefault((name, endpoint), Histogram(buckets)).observe(value)
+            self._requests[(endpoint, status)] += 1
+            if repeated:
+                self._n_plus_one[endpoint] += 1
+
+    # текстовый формат Prometheus
+    def export(self):
+        lines = []
+        with self._lock:
+            for name, description, _ in self.HISTOGRAMS:
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} histogram")
+                for (histogram_name, endpoint), histogram in sorted(self._histograms.items()):
+                    if histogram_name == name:
+                        lines.extend(histogram.export(name, f'endpoint="{_escape(endpoint)}"'))
+            lines.append("# HELP http_requests_total Число запросов")
+            lines.append("# TYPE http_requests_total counter")
+            for (endpoint, status), count in sorted(self._requests.items()):
+                lines.append(f'http_requests_total{{endpoint="{_escape(endpoint)}",status="{status}"}} {count}')
+            lines.append("# HELP http_requests_n_plus_one_total Запросы, в которых найден N+1")
+            lines.append("# TYPE http_requests_n_plus_one_total counter")
+            for endpoint, count in sorted(self._n_plus_one.items()):
+                lines.append(f'http_requests_n_plus_one_total{{endpoint="{_escape(endpoint)}"}} {count}')
+        return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
@@ -0,0 +1,185 @@
+# миграции схемы для уже существующих баз данных (например, north_photos_project.db)
+# каждый шаг идемпотентен: повторный запуск ничего не ломает
+from sqlalchemy import Date, inspect, text
+
+
+def _columns(conn, table):
+    return {column["name"]: column["type"] for column in inspect(conn).get_columns(table)}
+
+
+def _indexes(conn, table):
+    return {index["name"] for index in inspect(conn).get_indexes(table)}
+
+
+# пересчитать сохраненное число голосов у всех фото
+def backfill_vote_counts(conn):
+    conn.execute(text(
+        "UPDATE photos SET vote_count = "
+        "(SELECT COUNT(*) FROM votes WHERE votes.photo_id = photos.id)"
+    ))
+
+
+# денормализованный счетчик голосов и индекс для сортировки ленты
+def add_vote_count(conn):
+    if "vote_count" not in _columns(conn, "photos"):
+        conn.execute(text("ALTER TABLE photos ADD COLUMN vote_count INTEGER NOT NULL DEFAULT 0"))
+        backfill_vote_counts(conn)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_photos_vote_count_id ON photos (vote_count, id)"))
+
+
+# ссылки на уменьшенные копии фото в кэше
+def add_image_columns(conn):
+    columns = _columns(conn, "photos")
+    if "img_hash" not in columns:
+        conn.execute(text("ALTER TABLE photos ADD COLUMN img_hash VARCHAR(64)"))
+    if "img_width" not in columns:
+        conn.execute(text("ALTER TABLE photos ADD COLUMN img_width INTEGER"))
+    if "img_placeholder" not in columns:
+        conn.execute(text("ALTER TABLE photos ADD COLUMN img_placeholder TEXT"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_photos_img_hash ON photos (img_hash)"))
+
+
+# индекс для проверки голоса пользователя за фото
+def add_votes_photo_author_index(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_votes_photo_id_author_id ON votes (photo_id, author_id)"))
+
+
+# один голос пользователя за фото: дубликаты удаляются (остается самый ранний),
+# затем создается уникальный индекс и пересчитываются счетчики
+def add_votes_unique_index(conn):
+    if "uq_votes_author_id_photo_id" in _indexes(conn, "votes"):
+        return
+    conn.execute(text(
+        "DELETE FROM votes WHERE id NOT IN "
+        "(SELECT MIN(id) FROM votes GROUP BY author_id, photo_id)"
+    ))
+    conn.execute(text("CREATE UNIQUE INDEX uq_votes_author_id_photo_id ON votes (author_id, photo_id)"))
+    backfill_vote_counts(conn)
+
+
+# дата фото из строки "дд.мм.гггг" в DATE, у голосов появляется время
+# SQLite не умеет менять тип столбца, но и DATE хранит как текст "гггг-мм-дд",
+# поэтому там достаточно переписать значения; в Postgres меняется сам тип
+def add_real_dates(conn):
+    if conn.dialect.name == "postgresql":
+        if not isinstance(_columns(conn, "photos")["date"], Date):
+            conn.execute(text(
+                "ALTER TABLE photos ALTER COLUMN date TYPE DATE USING to_date(date, 'DD.MM.YYYY')"
+            ))
+    else:
+        conn.execute(text(
+            "UPDATE photos SET date = substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2) "
+            "WHERE date LIKE '__.__.____'"
+        ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_photos_date ON photos (date)"))
+    if "created_at" not in _columns(conn, "votes"):
+        column_type = "TIMESTAMP" if conn.dialect.name == "postgresql" else "DATETIME"
+        conn.execute(text(f"ALTER TABLE votes ADD COLUMN created_at {column_type}"))
+        # время старых голосов неизвестно - берется дата публикации фото
+        created_at = "photos.date::timestamp" if conn.dialect.name == "postgresql" else "photos.date || ' 00:00:00.000000'"
+        conn.execute(text(
+            f"UPDATE votes SET created_at = (SELECT {created_at} FROM photos WHERE photos.id = votes.photo_id) "
+            "WHERE created_at IS NULL"
+        ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_votes_created_at ON votes (created_at)"))
+
+
+# полнотекстовый поиск по названию, месту, имени и филиалу автора
+# SQLite: таблица FTS5, которую поддерживают триггеры; "ё" заменяется на "е", как и в запросе
+_SQLITE_FTS_COLUMNS = (
+    "replace(replace({photo}.photo_title, 'ё', 'е'), 'Ё', 'Е'), "
+    "replace(replace({photo}.photo_place, 'ё', 'е'), 'Ё', 'Е'), "
+    "(SELECT replace(replace(coalesce(first_name, '') || ' ' || coalesce(last_name, ''), 'ё', 'е'), 'Ё', 'Е') "
+    "FROM user WHERE user.id = {photo}.author_id), "
+    "(SELECT replace(replace(department, 'ё', 'е'), 'Ё', 'Е') FROM user WHERE user.id = {photo}.author_id)"
+)
+_SQLITE_FTS = [
+    "CREATE VIRTUAL TABLE photos_fts USING fts5("
+    "photo_title, photo_place, author_name, department, tokenize = 'unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER photos_fts_insert AFTER INSERT ON photos BEGIN "
+    "INSERT INTO photos_fts (rowid, photo_title, photo_place, author_name, department) "
+    f"VALUES (new.id, {_SQLITE_FTS_COLUMNS.format(photo='new')}); END",
+    "CREATE TRIGGER photos_fts_update AFTER UPDATE OF photo_title, photo_place, author_id ON photos BEGIN "
+    "DELETE FROM photos_fts WHERE rowid = old.id; "
+    "INSERT INTO photos_fts (rowid, photo_title, photo_place, author_name, department) "
+    f"VALUES (new.id, {_SQLITE_FTS_COLUMNS.format(photo='new')}); END",
+    "CREATE TRIGGER photos_fts_delete AFTER DELETE ON photos BEGIN "
+    "DELETE FROM photos_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER user_photos_fts_update AFTER UPDATE OF first_name, last_name, department ON user BEGIN "
+    "DELETE FROM photos_fts WHERE rowid IN (SELECT id FROM photos WHERE author_id = new.id); "
+    "INSERT INTO photos_fts (rowid, photo_title, photo_place, author_name, department) "
+    f"SELECT photos.id, {_SQLITE_FTS_COLUMNS.format(photo='photos')} FROM photos WHERE photos.author_id = new.id; END",
+    "INSERT INTO photos_fts (rowid, photo_title, photo_place, author_name, department) "
+    f"SELECT photos.id, {_SQLITE_FTS_COLUMNS.format(photo='photos')} FROM photos",
+]
+# Postgres: столбец tsvector с русской морфологией, который заполняет триггер, и GIN-индекс по нему
+_POSTGRES_FTS = [
+    "ALTER TABLE photos ADD COLUMN search_vector tsvector",
+    """CREATE OR REPLACE FUNCTION photos_search_vector_update() RETURNS trigger AS $$
+    DECLARE
+        author RECORD;
+    BEGIN
+        SELECT first_name, last_name, department INTO author FROM "user" WHERE id = NEW.author_id;
+        NEW.search_vector :=
+            setweight(to_tsvector('russian', coalesce(NEW.photo_title, '')), 'A') ||
+            setweight(to_tsvector('russian', coalesce(NEW.photo_place, '')), 'B') ||
+            setweight(to_tsvector('russian', coalesce(author.first_name, '') || ' ' || coalesce(author.last_name, '')), 'C') ||
+            setweight(to_tsvector('russian', coalesce(author.department, '')), 'D');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql""",
+    "CREATE TRIGGER photos_search_vector_trigger BEFORE INSERT OR UPDATE OF photo_title, photo_place, author_id "
+    "ON photos FOR EACH ROW EXECUTE PROCEDURE photos_search_vector_update()",
+    # смена имени или филиала пересчитывает поиск по всем фото автора
+    """CREATE OR REPLACE FUNCTION user_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        UPDATE photos SET photo_title = photo_title WHERE author_id = NEW.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    'CREATE TRIGGER user_search_vector_trigger AFTER UPDATE OF first_name, last_name, department '
+    'ON "user" FOR EACH ROW EXECUTE PROCEDURE user_search_vector_update()',
+    "UPDATE photos SET photo_title = photo_title",
+    "CREATE INDEX ix_photos_search_vector ON photos USING GIN (search_vector)",
+]
+
+
+def add_search_index(conn):
+    if conn.dialect.name == "postgresql":
+        if "search_vector" in _columns(conn, "photos"):
+            return
+        statements = _POSTGRES_FTS
+    else:
+        if inspect(conn).has_table("photos_fts"):
+            return
+        statements = _SQLITE_FTS
+    for statement in statements:
+        conn.execute(text(statement))
+
+
+# рейтинги пересчитываются по времени голосов, а не по их id: id выдаются при вставке,
+# а видны после commit, и голос из параллельной транзакции мог бы не попасть в рейтинг;
+# состояние - это только кэш, поэтому таблица создается заново и рейтинги строятся с нуля
+def add_leaderboard_built_at(conn):
+    if not inspect(conn).has_table("leaderboard_state") or "built_at" in _columns(conn, "leaderboard_state"):
+        return
+    column_type = "TIMESTAMP" if conn.dialect.name == "postgresql" else "DATETIME"
+    conn.execute(text("DROP TABLE leaderboard_state"))
+    conn.execute(text(f"CREATE TABLE leaderboard_state (id INTEGER NOT NULL, built_at {column_type}, PRIMARY KEY (id))"))
+
+
+MIGRATIONS = [
+    add_vote_count,
+    add_image_columns,
+    add_votes_photo_author_index,
+    add_votes_unique_index,
+    add_real_dates,
+    add_search_index,
+    add_leaderboard_built_at,
+]
+
+
+def upgrade(engine):
+    with engine.begin() as conn:
+        for migration in MIGRATIONS:
+            migration(conn)
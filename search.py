@@ -0,0 +1,57 @@
+# поиск фото по названию, месту, имени и филиалу автора через полнотекстовый индекс
+# (migrations.add_search_index): в SQLite - FTS5, в Postgres - tsvector с GIN-индексом
+import re
+
+from sqlalchemy import text
+
+try:
+    import snowballstemmer
+    _stemmer = snowballstemmer.stemmer("russian")
+except ImportError:
+    _stemmer = None
+
+# веса полей: название, место, автор, филиал
+SQLITE_WEIGHTS = (10.0, 5.0, 2.0, 1.0)
+MAX_TERMS = 8
+
+
+def _terms(query):
+    words = re.findall(r"\w+", query.lower().replace("ё", "е"))[:MAX_TERMS]
+    if _stemmer is not None:
+        words = _stemmer.stemWords(words)
+    return [word for word in words if word]
+
+
+# запрос FTS5: каждое слово без окончания ищется как префикс ("оленей" -> "олен"*),
+# поэтому находятся и другие формы слова; кавычки не дают пользователю писать синтаксис FTS
+def sqlite_match_query(query):
+    return " ".join(f'"{term}"*' for term in _terms(query))
+
+
+def _search_sqlite(conn, query, limit, offset):
+    match = sqlite_match_query(query)
+    if not match:
+        return []
+    rows = conn.execute(text(
+        f"SELECT rowid FROM photos_fts WHERE photos_fts MATCH :match "
+        f"ORDER BY bm25(photos_fts, {', '.join(map(str, SQLITE_WEIGHTS))}) LIMIT :limit OFFSET :offset"
+    ), {"match": match, "limit": limit, "offset": offset})
+    return [photo_id for photo_id, in rows]
+
+
+def _search_postgres(conn, query, limit, offset):
+    if not _terms(query):
+        return []
+    rows = conn.execute(text(
+        "SELECT id FROM photos, websearch_to_tsquery('russian', :query) AS query "
+        "WHERE search_vector @@ query "
+        "ORDER BY ts_rank_cd(search_vector, query) DESC, id DESC LIMIT :limit OFFSET :offset"
+    ), {"query": query, "limit": limit, "offset": offset})
+    return [photo_id for photo_id, in rows]
+
+
+# id найденных фото по убыванию релевантности
+def search_photo_ids(conn, query, limit, offset=0):
+    if conn.dialect.name == "postgresql":
+        return _search_postgres(conn, query, limit, offset)
+    return _search_sqlite(conn, query, limit, offset)
@@ -0,0 +1,127 @@
+# генератор тестовых данных для нагрузочных замеров:
+#   python seed.py --database-uri sqlite:///bench.db --users 10000 --photos 50000 --votes 2000000
+# у всех созданных пользователей пароль SEED_PASSWORD, почта seed-<метка>-<номер>@example.com
+import itertools
+import random
+import uuid
+from datetime import date, datetime, timedelta
+
+import click
+from werkzeug.security import generate_password_hash
+
+SEED_PASSWORD = "password"
+CHUNK_SIZE = 5000
+
+PLACES = ["Новый Уренгой", "Ямбург", "Тазовский", "Пангоды", "Надым", "Салехард", "Уренгойское месторождение"]
+SUBJECTS = ["Тундра", "Северное сияние", "Олени", "Зимник", "Яранга", "Река Пур", "Полярная ночь", "Буровая"]
+DEPARTMENTS = ["Управление", "ГП-1", "ГП-2", "УТТ", "УМТСиК", "ИТЦ", "Служба связи"]
+FIRST_NAMES = ["Иван", "Мария", "Алексей", "Ольга", "Сергей", "Анна", "Дмитрий", "Елена"]
+LAST_NAMES = ["Иванов", "Петрова", "Сидоров", "Кузнецова", "Смирнов", "Попова", "Васильев", "Соколова"]
+
+
+def chunks(rows, size=CHUNK_SIZE):
+    iterator = iter(rows)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# вставка пачками одним executemany без создания ORM-объектов
+def bulk_insert(db, table, rows):
+    total = 0
+    for chunk in chunks(rows):
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        total += len(chunk)
+    return total
+
+
+# популярность фото неравномерная: немного фото собирают большую часть голосов
+def popularity_weights(count, skew):
+    return list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(count)))
+
+
+def seed(db, models, users, photos, votes, comments, months=12, skew=0.8, random_seed=None):
+    User, Photo, Vote, Comment = models
+    rng = random.Random(random_seed)
+    tag = uuid.uuid4().hex[:8]
+    today = date.today()
+    # один хэш на всех: pbkdf2 для каждого пользователя занял бы минуты
+    password = generate_password_hash(SEED_PASSWORD, method="pbkdf2:sha256", salt_length=8)
+
+    bulk_insert(db, User.__table__, ({
+        "email": f"seed-{tag}-{number}@example.com",
+        "password": password,
+        "first_name": rng.choice(FIRST_NAMES),
+        "last_name": rng.choice(LAST_NAMES),
+        "department": rng.choice(DEPARTMENTS),
+    } for number in range(users)))
+    user_ids = [user_id for user_id, in db.session.query(User.id).filter(User.email.like(f"seed-{tag}-%"))]
+
+    first_photo_id = (db.session.query(db.func.max(Photo.id)).scalar() or 0) + 1
+    bulk_insert(db, Photo.__table__, ({
+        "author_id": rng.choice(user_ids),
+        "photo_title": f"{rng.choice(SUBJECTS)} {number}",
+        "photo_place": rng.choice(PLACES),
+        "date": today - timedelta(days=rng.randrange(months * 30)),
+        "img_url": f"https://picsum.photos/seed/{tag}-{number}/1600/1067",
+        "vote_count": 0,
+    } for number in range(photos)))
+    photo_dates = dict(db.session.query(Photo.id, Photo.date).filter(Photo.id >= first_photo_id))
+    photo_ids = list(photo_dates)
+
+    # каждый пользователь голосует за фото не больше одного раза
+    def vote_rows():
+        cum_weights = popularity_weights(len(photo_ids), skew)
+        per_user, remainder = divmod(min(votes, len(user_ids) * len(photo_ids)), len(user_ids))
+        for index, user_id in enumerate(user_ids):
+            wanted = min(per_user + (index < remainder), len(photo_ids))
+            chosen = set()
+            while len(chosen) < wanted:
+                chosen.update(rng.choices(photo_ids, cum_weights=cum_weights, k=wanted - len(chosen)))
+            for photo_id in chosen:
+                published = datetime.combine(photo_dates[photo_id], datetime.min.time())
+                seconds_since = max(int((datetime.utcnow() - published).total_seconds()), 1)
+                yield {
+                    "author_id": user_id,
+                    "photo_id": photo_id,
+                    "like": 1,
+                    "created_at": published + timedelta(seconds=rng.randrange(seconds_since)),
+                }
+
+    inserted_votes = bulk_insert(db, Vote.__table__, vote_rows())
+    inserted_comments = bulk_insert(db, Comment.__table__, ({
+        "photo_id": rng.choice(photo_ids),
+        "author_id": rng.choice(user_ids),
+        "comment_text": "<p>Отличное фото!</p>",
+    } for _ in range(comments)))
+    return {"tag": tag, "users": len(user_ids), "photos": len(photo_ids), "votes": inserted_votes, "comments": inserted_comments}
+
+
+@click.command()
+@click.option("--database-uri", help="Адрес базы, по умолчанию - база приложения")
+@click.option("--users", default=10000, show_default=True)
+@click.option("--photos", default=50000, show_default=True)
+@click.option("--votes", default=2000000, show_default=True)
+@click.option("--comments", default=0, show_default=True)
+@click.option("--months", default=12, show_default=True, help="За сколько месяцев распределить даты фото")
+@click.option("--skew", default=0.8, show_default=True, help="Неравномерность популярности фото (0 - равномерно)")
+@click.option("--random-seed", type=int, help="Для воспроизводимых данных")
+def seed_command(database_uri, users, photos, votes, comments, months, skew, random_seed):
+    from main import app, db, User, Photo, Vote, Comment
+    import migrations
+    if database_uri:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+    with app.app_context():
+        db.create_all()
+        migrations.upgrade(db.engine)
+        result = seed(db, (User, Photo, Vote, Comment), users, photos, votes, comments, months, skew, random_seed)
+        with db.engine.begin() as conn:
+            migrations.backfill_vote_counts(conn)
+    click.echo(result)
+
+
+if __name__ == "__main__":
+    seed_command()
@@ -0,0 +1,85 @@
+/*
+	Подгрузка ленты фото при прокрутке (/api/photos?after=<курсор>).
+	Первая страница рендерится на сервере, без JS работает ссылка "Показать еще".
+*/
+
+(function($) {
+
+	var $more = $('#feed_more'),
+		$tiles = $('#one.tiles'),
+		loading = false;
+
+	if ($more.length == 0 || !('IntersectionObserver' in window))
+		return;
+
+	// Escape text for HTML.
+		function escapeHtml(text) {
+			return $('<div/>').text(text).html();
+		}
+
+	// Build tile (same markup and behaviour as main.js tiles).
+		function buildTile(photo) {
+
+			var $article = $(
+				'<article>' +
+					'<span class="image"><img src="" alt="" /></span>' +
+					'<header class="major">' +
+						'<h3><a class="link"></a></h3>' +
+						'<p>Фото сделано: ' + escapeHtml(photo.photo_place) + '</p>' +
+						'<p>Голоса: ' + photo.vote_count + '</p>' +
+					'</header>' +
+				'</article>'
+			);
+
+			$article.find('img').attr('src', photo.tile_url);
+			$article.find('.link').attr('href', photo.url).text(photo.photo_title);
+			$article.css('background-image', 'url(' + photo.tile_url + ')');
+			$article.find('.image').hide();
+			$('<a class="link primary"></a>').attr('href', photo.url).appendTo($article);
+
+			return $article;
+
+		}
+
+	// Load next page.
+		function loadMore() {
+
+			var cursor = $more.data('cursor');
+
+			if (loading || !cursor)
+				return;
+
+			loading = true;
+
+			$.getJSON($more.data('api'), { after: cursor }, function(data) {
+
+				$.each(data.photos, function(i, photo) {
+					$tiles.append(buildTile(photo));
+				});
+
+				// Re-observe so a still visible sentinel triggers the next page.
+				if (data.next) {
+					$more.data('cursor', data.next);
+					observer.unobserve($more[0]);
+					observer.observe($more[0]);
+				}
+				else {
+					observer.disconnect();
+					$more.remove();
+				}
+
+			}).always(function() {
+				loading = false;
+			});
+
+		}
+
+	var observer = new IntersectionObserver(function(entries) {
+		if (entries[0].isIntersecting)
+			loadMore();
+	}, { rootMargin: '400px' });
+
+	$more.find('.actions').hide();
+	observer.observe($more[0]);
+
+})(jQuery);
@@ -0,0 +1,92 @@
+# число SQL-запросов на странице фото не должно зависеть от числа голосов за фото
+# запуск из корня проекта: python -m unittest discover tests
+import os
+import sys
+import tempfile
+import unittest
+from datetime import date, datetime
+
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+import migrations
+from main import app, db, User, Photo, Vote
+
+PASSWORD = "password"
+MANY_VOTES = 50
+
+
+class PhotoQueryCountTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.TemporaryDirectory()
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(cls.work_dir.name, "test.db"),
+            SECRET_KEY="test",
+            WTF_CSRF_ENABLED=False,
+        )
+        # без кэша описание фото рендерится на каждый запрос, и его запросы тоже считаются
+        cls.fragment_cache_ttl = main.fragment_cache.ttl
+        main.fragment_cache.ttl = 0
+        with app.app_context():
+            db.create_all()
+            migrations.upgrade(db.engine)
+            password = generate_password_hash(PASSWORD, method="pbkdf2:sha256", salt_length=8)
+            users = [User(email=f"user-{number}@example.com", password=password, first_name="Иван",
+                          last_name="Иванов", department="ГП-1") for number in range(MANY_VOTES)]
+            db.session.add_all(users)
+            one_vote = Photo(photo_title="Тундра", photo_place="Ямбург", date=date.today(),
+                             img_url="/static/images/pic01.jpg", photo_author=users[0], vote_count=1)
+            many_votes = Photo(photo_title="Олени", photo_place="Надым", date=date.today(),
+                               img_url="/static/images/pic01.jpg", photo_author=users[0], vote_count=MANY_VOTES)
+            db.session.add_all([one_vote, many_votes])
+            db.session.flush()
+            db.session.add(Vote(voting_user=users[1], parent_photo=one_vote, like=1, created_at=datetime.utcnow()))
+            db.session.add_all(Vote(voting_user=user, parent_photo=many_votes, like=1, created_at=datetime.utcnow())
+                               for user in users)
+            db.session.commit()
+            cls.photo_ids = (one_vote.id, many_votes.id)
+            cls.engine = db.engine
+            # не автор фото: иначе автор, загруженный вместе с фото, заменил бы запрос пользователя
+            cls.user_email = users[1].email
+
+    @classmethod
+    def tearDownClass(cls):
+        main.fragment_cache.ttl = cls.fragment_cache_ttl
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        cls.work_dir.cleanup()
+
+    def count_queries(self, client, photo_id):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", count)
+        try:
+            response = client.get("/photo", query_string={"photo_id": photo_id})
+        finally:
+            event.remove(self.engine, "before_cursor_execute", count)
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def test_anonymous(self):
+        client = app.test_client()
+        counts = [self.count_queries(client, photo_id) for photo_id in self.photo_ids]
+        self.assertEqual(counts, [2, 2])
+
+    def test_logged_in(self):
+        client = app.test_client()
+        response = client.post("/login", data={"email": self.user_email, "password": PASSWORD})
+        self.assertEqual(response.status_code, 302)
+        counts = [self.count_queries(client, photo_id) for photo_id in self.photo_ids]
+        self.assertEqual(counts, [4, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+# отложенная запись: элементы копятся в ограниченной очереди в памяти процесса
+# и сбрасываются пачками по размеру или по времени; при выходе процесса очередь дописывается;
+# пачка, которую не удалось записать, возвращается в очередь и пишется повторно
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    # flush - функция, которая получает список элементов и записывает их одной пачкой
+    def __init__(self, flush, batch_size=500, interval=1.0, max_size=10000, max_delay=60.0, drain_attempts=3):
+        self.flush = flush
+        self.batch_size = batch_size
+        self.interval = interval
+        # пауза после неудачной записи растет вдвое до max_delay секунд
+        self.max_delay = max_delay
+        # сколько неудачных попыток допускается при дописывании очереди на выходе
+        self.drain_attempts = drain_attempts
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.drain)
+
+    # поток запускается при первой записи в каждом процессе: воркеры gunicorn создаются fork'ом
+    def _ensure_thread(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    # False - очередь переполнена, элемент нужно записать сразу
+    def put(self, item):
+        if self._stopped.is_set():
+            return False
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+    def _take_batch(self, timeout):
+        batch = []
+        deadline = time.monotonic() + timeout
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=max(remaining, 0)) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    # True - пачка записана; иначе она возвращается в очередь
+    def _write(self, batch):
+        try:
+            self.flush(batch)
+            return True
+        except Exception:
+            logger.exception("не удалось записать пачку из %d элементов, она будет записана повторно", len(batch))
+        lost = []
+        for item in batch:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                lost.append(item)
+        if lost:
+            logger.error("очередь переполнена, потеряно %d элементов: %r", len(lost), lost)
+        return False
+
+    def _run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            batch = self._take_batch(self.interval)
+            if not batch:
+                continue
+            if self._write(batch):
+                failures = 0
+            else:
+                failures += 1
+                self._stopped.wait(min(self.interval * 2 ** failures, self.max_delay))
+
+    # остановить поток и записать все, что осталось в очереди
+    def drain(self):
+        self._stopped.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=self.interval + 5)
+        failures = 0
+        while failures < self.drain_attempts:
+            batch = self._take_batch(0)
+            if not batch:
+                return
+            if not self._write(batch):
+                failures += 1
+                time.sleep(self.interval)
+        lost = self._take_batch(0)
+        while lost:
+            logger.error("не удалось дописать очередь, потеряно %d элементов: %r", len(lost), lost)
+            lost = self._take_batch(0)